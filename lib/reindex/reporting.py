@@ -17,6 +17,10 @@ _log = logging.getLogger('utapi-reindex:reporting')
 SENTINEL_CONNECT_TIMEOUT_SECONDS = 10
 EXIT_CODE_SENTINEL_CONNECTION_ERROR = 100
 
+# Sorted sets maintained by s3_bucketd.py, scored by the latest reindexed value.
+# Scores are doubles, so values above 2^53 are not exact when read back.
+RANKING_KEY_FORMAT = 's3:utapireindex:ranking:%s:%s'
+
 def get_options():
     parser = argparse.ArgumentParser()
     parser.add_argument("-i", "--sentinel-ip", default='127.0.0.1', help="Sentinel IP")
@@ -24,8 +28,24 @@ def get_options():
     parser.add_argument("-v", "--redis-password", default=None, help="Redis AUTH Password")
     parser.add_argument("-n", "--sentinel-cluster-name", default='scality-s3', help="Redis cluster name")
     parser.add_argument("-b", "--bucketd-addr", default='http://127.0.0.1:9000', help="URL of the bucketd server")
+    parser.add_argument("--resource", default='buckets', choices=['buckets', 'accounts'], help="Resource type to rank")
+    parser.add_argument("--metric", default='storageUtilized', choices=['storageUtilized', 'numberOfObjects'], help="Metric to rank by")
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("--top", default=None, type=positive_int('top'), help="Only report the N largest resources")
+    group.add_argument("--range", default=None, type=int, nargs=2, metavar=('MIN', 'MAX'), help="Only report resources with a metric value between MIN and MAX")
     return parser.parse_args()
 
+def positive_int(flag):
+    def inner(value):
+        try:
+            value = int(value)
+        except ValueError:
+            raise argparse.ArgumentTypeError("%s: value must be an integer"%flag)
+        if value < 1:
+            raise argparse.ArgumentTypeError("%s: value must be at least 1"%flag)
+        return value
+    return inner
+
 def safe_print(content):
     print("{0}".format(content))
 
@@ -59,6 +79,18 @@ class askRedis():
         except Exception as e:
             return {'files': 0, "total_size": 0}
 
+    def top(self, resource, metric, count):
+        r = redis.Redis(host=self._ip, port=self._port, db=0, password=self._password)
+        res = RANKING_KEY_FORMAT % (resource, metric)
+        return [(name.decode('utf-8'), int(score))
+                for name, score in r.zrevrange(res, 0, count - 1, withscores=True)]
+
+    def range(self, resource, metric, minimum, maximum):
+        r = redis.Redis(host=self._ip, port=self._port, db=0, password=self._password)
+        res = RANKING_KEY_FORMAT % (resource, metric)
+        return [(name.decode('utf-8'), int(score))
+                for name, score in r.zrangebyscore(res, minimum, maximum, withscores=True)]
+
 
 class S3ListBuckets():
 
@@ -90,6 +122,16 @@ if __name__ == '__main__':
         password=options.redis_password
     )
 
+    if options.top is not None or options.range is not None:
+        U = askRedis(**redis_conf)
+        if options.top is not None:
+            ranking = U.top(options.resource, options.metric, options.top)
+        else:
+            ranking = U.range(options.resource, options.metric, *options.range)
+        for name, value in ranking:
+            safe_print("Resource:%s|Name:%s|%s:%s " % (options.resource, name, options.metric, value))
+        sys.exit(0)
+
     P = S3ListBuckets(options.bucketd_addr)
     listbuckets = P.run()
 
@@ -1,15 +1,26 @@
 import argparse
+import atexit
 import concurrent.futures as futures
+import contextlib
+import cProfile
 import functools
+import gzip
+import hashlib
 import itertools
 import json
 import logging
+import math
+import os
+import queue
+import random
 import re
+import statistics
 import sys
+import threading
 import time
 import urllib
 import uuid
-from collections import namedtuple
+from collections import defaultdict, deque, namedtuple
 from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
@@ -26,6 +37,41 @@ MPU_SHADOW_BUCKET_PREFIX = 'mpuShadowBucket'
 
 ACCOUNT_UPDATE_CHUNKSIZE = 100
 
+# Sorted sets of resource names scored by their latest value, e.g. s3:utapireindex:ranking:buckets:storageUtilized
+RANKING_KEY_FORMAT = 's3:utapireindex:ranking:%s:%s'
+# Set of the bucket names last reported for an account, used to clear stale buckets without a keyspace scan
+ACCOUNT_BUCKETS_KEY_FORMAT = 's3:utapireindex:accountbuckets:%s'
+
+DISCOVERY_DEFAULT_WORKERS = 4
+# Key range boundaries of users..bucket listed concurrently, keys start with a hex canonical ID
+DISCOVERY_RANGE_BOUNDARIES = [''] + list('123456789abcdef')
+
+ESTIMATE_DEFAULT_SAMPLES = 16
+ESTIMATE_DEFAULT_THRESHOLD = 10000
+# z-score for a 95% confidence interval
+ESTIMATE_Z_SCORE = 1.96
+# Number of characters a key range can be split on
+ESTIMATE_SPLIT_CHARACTERS = sys.maxunicode + 1
+# Versions listed to tell whether a key range is small enough to be counted exactly
+ESTIMATE_PROBE_SIZE = 1000
+# Large key ranges are split until there are this many per sample
+ESTIMATE_RANGES_PER_SAMPLE = 16
+ESTIMATE_MAX_PREFIX_LENGTH = 32
+
+# Consecutive failures before a bucketd endpoint is evicted, and for how long
+ENDPOINT_EVICTION_FAILURES = 3
+ENDPOINT_EVICTION_SECONDS = 30
+# Weight of the latest request when updating an endpoint's latency average
+ENDPOINT_LATENCY_SMOOTHING = 0.2
+
+CASSETTE_VERSION = 1
+# Anonymised keys are never shorter than this to avoid collisions
+CASSETTE_MIN_ANONYMISED_LENGTH = 12
+CASSETTE_KEY_SPLITTER = '..|..'
+# Metadata fields kept in anonymised values, the ones read by the reindexer
+CASSETTE_KEPT_VALUE_FIELDS = ('Size', 'content-length', 'UploadId')
+CASSETTE_VALUE_PADDING_FIELD = 'padding'
+
 SENTINEL_CONNECT_TIMEOUT_SECONDS = 10
 EXIT_CODE_SENTINEL_CONNECTION_ERROR = 100
 
@@ -35,12 +81,25 @@ def get_options():
     parser.add_argument("-p", "--sentinel-port", default="16379", help="Sentinel Port")
     parser.add_argument("-v", "--redis-password", default=None, help="Redis AUTH Password")
     parser.add_argument("-n", "--sentinel-cluster-name", default='scality-s3', help="Redis cluster name")
-    parser.add_argument("-s", "--bucketd-addr", default='http://127.0.0.1:9000', help="URL of the bucketd server")
+    parser.add_argument("-s", "--bucketd-addr", default='http://127.0.0.1:9000', type=address_list, help="URL of the bucketd server, or a comma separated list of URLs")
     parser.add_argument("-w", "--worker", default=10, type=int, help="Number of workers")
+    parser.add_argument("--discovery-workers", default=DISCOVERY_DEFAULT_WORKERS, type=int, help="Number of concurrent listings used to discover buckets")
     parser.add_argument("-r", "--max-retries", default=2, type=int, help="Max retries before failing a bucketd request")
     parser.add_argument("--only-latest-when-locked", action='store_true', help="Only index the latest version of a key when the bucket has a default object lock policy")
     parser.add_argument("--debug", action='store_true', help="Enable debug logging")
+    parser.add_argument("--profile", default=None, help="Write per bucket phase timings to this file, in folded stack format for flamegraphs")
+    parser.add_argument("--profile-bucket", default=[], action="append", type=nonempty_string('profile-bucket'), help="Run cProfile while indexing this bucket, stats are written next to the --profile file")
+    cassette = parser.add_mutually_exclusive_group()
+    cassette.add_argument("--record", default=None, help="Record bucketd traffic to this gzipped cassette file")
+    cassette.add_argument("--replay", default=None, type=existing_file, help="Serve bucketd traffic from this cassette file instead of bucketd")
+    parser.add_argument("--record-anonymise", action='store_true', help="Anonymise object keys in the recorded cassette")
+    parser.add_argument("--replay-speed", default=1.0, type=float, help="Replay speed factor relative to the recorded latencies, 0 disables delays")
     parser.add_argument("--dry-run", action="store_true", help="Do not update redis")
+    parser.add_argument("--estimate", action="store_true", help="Estimate the contents of large buckets from key range samples instead of counting them")
+    parser.add_argument("--estimate-samples", default=ESTIMATE_DEFAULT_SAMPLES, type=positive_int('estimate-samples'), help="Number of key ranges sampled per large bucket when estimating")
+    parser.add_argument("--estimate-threshold", default=ESTIMATE_DEFAULT_THRESHOLD, type=positive_int('estimate-threshold'), help="Buckets listing more entries than this are estimated, smaller ones are counted exactly")
+    parser.add_argument("--estimate-seed", default=None, type=int, help="Seed used to choose the sampled key ranges")
+    parser.add_argument("--estimate-write", action="store_true", help="Write estimates to redis")
     group = parser.add_mutually_exclusive_group()
     group.add_argument("-a", "--account", default=[], help="account canonical ID (all account buckets will be processed)", action="append", type=nonempty_string('account'))
     group.add_argument("--account-file", default=None, help="file containing account canonical IDs, one ID per line", type=existing_file)
@@ -48,6 +107,10 @@ def get_options():
     group.add_argument("--bucket-file", default=None, help="file containing bucket names, one bucket name per line", type=existing_file)
 
     options = parser.parse_args()
+    if options.profile_bucket and not options.profile:
+        parser.error('--profile-bucket requires --profile')
+    if options.record_anonymise and not options.record:
+        parser.error('--record-anonymise requires --record')
     if options.bucket_file:
         with open(options.bucket_file) as f:
             options.bucket = [line.strip() for line in f if line.strip()]
@@ -64,6 +127,23 @@ def nonempty_string(flag):
         return value
     return inner
 
+def positive_int(flag):
+    def inner(value):
+        try:
+            value = int(value)
+        except ValueError:
+            raise argparse.ArgumentTypeError("%s: value must be an integer"%flag)
+        if value < 1:
+            raise argparse.ArgumentTypeError("%s: value must be at least 1"%flag)
+        return value
+    return inner
+
+def address_list(value):
+    addrs = [addr.strip().rstrip('/') for addr in value.split(',') if addr.strip()]
+    if not addrs:
+        raise argparse.ArgumentTypeError("bucketd-addr: value must not be empty")
+    return addrs
+
 def existing_file(path):
     path = Path(path).resolve()
     if not path.exists():
@@ -86,6 +166,7 @@ def _encoded(func):
 Bucket = namedtuple('Bucket', ['userid', 'name', 'object_lock_enabled'])
 MPU = namedtuple('MPU', ['bucket', 'key', 'upload_id'])
 BucketContents = namedtuple('BucketContents', ['bucket', 'obj_count', 'total_size'])
+BucketEstimate = namedtuple('BucketEstimate', ['bucket', 'obj_count', 'total_size', 'obj_count_margin', 'total_size_margin', 'exact'])
 
 class MaxRetriesReached(Exception):
     def __init__(self, url):
@@ -96,38 +177,448 @@ class InvalidListing(Exception):
         super().__init__('Invalid contents found while listing bucket %s'%bucket)
 
 class BucketNotFound(Exception):
-    def __init__(self, bucket):
+    def __init__(self, bucket, status_code=None):
         super().__init__('Bucket %s not found'%bucket)
+        self.status_code = status_code
+
+class NullProfiler:
+
+    '''Profiler used when profiling is disabled, all hooks are no-ops'''
+
+    class _NullPhase:
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc):
+            return False
+
+    _phase = _NullPhase()
+
+    def phase(self, name):
+        return self._phase
+
+    def bucket(self, name):
+        return self._phase
+
+    def write(self):
+        pass
+
+class PhaseProfiler:
+
+    '''
+    Accumulates the self time of nested phases per thread, keyed by their
+    stack, e.g. reindex;<bucket>;sum;http. Written in the folded stack format
+    read by flamegraph.pl and speedscope.
+    '''
+
+    class _Phase:
+        def __init__(self, profiler, name):
+            self._profiler = profiler
+            self._name = name
+
+        def __enter__(self):
+            self._profiler._stack().append([self._name, time.perf_counter(), 0.0])
+            return self
+
+        def __exit__(self, *exc):
+            stack = self._profiler._stack()
+            name, start, children = stack.pop()
+            elapsed = time.perf_counter() - start
+            if stack:
+                stack[-1][2] += elapsed
+            self._profiler._record([frame[0] for frame in stack] + [name], elapsed - children)
+            return False
+
+    def __init__(self, path, profiled_buckets=()):
+        self._path = path
+        self._profiled_buckets = set(profiled_buckets)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # Only one cProfile profiler can be active at a time since python 3.12
+        self._cprofile_lock = threading.Lock()
+        self._samples = defaultdict(float)
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def _record(self, frames, seconds):
+        with self._lock:
+            self._samples[';'.join(['reindex'] + frames)] += seconds
+
+    def phase(self, name):
+        return self._Phase(self, name)
+
+    def _start_cprofile(self, name):
+        '''Returns an enabled cProfile profiler for the bucket, or None'''
+        if name not in self._profiled_buckets:
+            return None
+        if not self._cprofile_lock.acquire(blocking=False):
+            _log.warning('Another bucket is being profiled, skipping cProfile for bucket:%s' % name)
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except Exception as e:
+            self._cprofile_lock.release()
+            _log.warning('Unable to profile bucket:%s error:%s' % (name, e))
+            return None
+        return profile
+
+    @contextlib.contextmanager
+    def bucket(self, name):
+        with self.phase(name):
+            profile = self._start_cprofile(name)
+            try:
+                yield
+            finally:
+                if profile is not None:
+                    try:
+                        profile.disable()
+                        profile.dump_stats('%s.%s.pstats' % (self._path, name))
+                    finally:
+                        self._cprofile_lock.release()
+
+    def write(self):
+        '''
+        Writes the folded stacks and logs a summary. Phases are summed by
+        self time, except mpu which includes the phases nested in it.
+        '''
+        totals = defaultdict(float)
+        with self._lock:
+            samples = sorted(self._samples.items())
+        with open(self._path, 'w') as f:
+            for stack, seconds in samples:
+                f.write('%s %d\n' % (stack, round(seconds * 1e6)))
+                frames = stack.split(';')
+                if 'mpu' in frames[:-1]:
+                    totals['mpu'] += seconds
+                totals[frames[-1]] += seconds
+        _log.info('Profile written to %s: %s' % (self._path, ', '.join(
+            '%s=%.3fs' % (phase, totals[phase]) for phase in ('http', 'decode', 'sum', 'mpu', 'redis') if phase in totals)))
+
+# Replaced in __main__ when --profile is passed
+_profiler = NullProfiler()
+
+class CassetteMiss(Exception):
+    def __init__(self, path):
+        super().__init__('No recorded response left for %s'%path)
+
+class KeyAnonymiser:
+
+    '''
+    Replaces object keys with salted hashes of a similar length.
+    The mapping is deterministic within a recording so versions of the same
+    key stay together and the MPU key structure is kept, but the order of
+    keys is not: anonymised cassettes can not be replayed with --estimate,
+    which compares keys with range boundaries.
+
+    Object metadata values are stripped down to CASSETTE_KEPT_VALUE_FIELDS,
+    in their original v6 dict or v7 JSON string form. v7 values are padded
+    back to their original length to keep decoding costs realistic.
+    '''
+    __payload_lists = ('Contents', 'Versions', 'Uploads', 'CommonPrefixes')
+    __payload_markers = ('NextKeyMarker', 'NextMarker')
+    __param_markers = ('keyMarker', 'marker', 'prefix')
+
+    def __init__(self, salt=None):
+        self._salt = salt if salt is not None else os.urandom(16)
+
+    def key(self, key):
+        return CASSETTE_KEY_SPLITTER.join(self._segment(s) for s in key.split(CASSETTE_KEY_SPLITTER))
+
+    def _segment(self, segment):
+        if not segment:
+            return segment
+        digest = hashlib.sha256(self._salt + segment.encode('utf-8')).hexdigest()
+        length = max(len(segment), CASSETTE_MIN_ANONYMISED_LENGTH)
+        return (digest * (length // len(digest) + 1))[:length]
+
+    def _value(self, value):
+        if isinstance(value, dict):
+            return {k: v for k, v in value.items() if k in CASSETTE_KEPT_VALUE_FIELDS}
+        if not isinstance(value, str):
+            return value
+        try:
+            data = json.loads(value)
+        except ValueError:
+            return ''
+        if not isinstance(data, dict):
+            return ''
+        kept = {k: v for k, v in data.items() if k in CASSETTE_KEPT_VALUE_FIELDS}
+        encoded = json.dumps(kept)
+        padding = len(value) - len(encoded) - len(', "%s": ""' % CASSETTE_VALUE_PADDING_FIELD)
+        if padding > 0:
+            kept[CASSETTE_VALUE_PADDING_FIELD] = 'x' * padding
+            encoded = json.dumps(kept)
+        return encoded
+
+    def _entry(self, entry):
+        if isinstance(entry, str):
+            return self.key(entry)
+        if isinstance(entry, dict) and 'key' in entry:
+            entry = dict(entry, key=self.key(entry['key']))
+            if 'value' in entry:
+                entry['value'] = self._value(entry['value'])
+        return entry
+
+    def params(self, params):
+        return {k: self.key(v) if k in self.__param_markers and isinstance(v, str) else v
+                for k, v in (params or {}).items()}
+
+    def body(self, text):
+        try:
+            payload = json.loads(text)
+        except ValueError:
+            return text
+        if isinstance(payload, list):
+            payload = [self._entry(e) for e in payload]
+        elif isinstance(payload, dict):
+            for name in self.__payload_lists:
+                if isinstance(payload.get(name), list):
+                    payload[name] = [self._entry(e) for e in payload[name]]
+            for name in self.__payload_markers:
+                if isinstance(payload.get(name), str):
+                    payload[name] = self.key(payload[name])
+        return json.dumps(payload)
+
+class RecordingSession:
+
+    '''
+    Wraps a requests.Session and appends every response to a gzipped
+    cassette, one JSON document per line.
+    '''
+
+    def __init__(self, path, session=None, anonymiser=None):
+        self._session = session if session is not None else requests.Session()
+        self._anonymiser = anonymiser
+        self._lock = threading.Lock()
+        self._file = gzip.open(path, 'wt', encoding='utf-8')
+        self._write({'version': CASSETTE_VERSION, 'anonymised': anonymiser is not None})
+
+    def _write(self, record):
+        with self._lock:
+            self._file.write(json.dumps(record) + '\n')
+
+    def get(self, url, params=None, **kwargs):
+        start = time.monotonic()
+        resp = self._session.get(url, params=params, **kwargs)
+        elapsed = time.monotonic() - start
+        path = urllib.parse.urlsplit(url).path
+        body = resp.text
+        # Bucket names are part of the request paths and must be kept for replay
+        if self._anonymiser is not None and not path.endswith('/' + USERS_BUCKET) and '/attributes/' not in path:
+            params = self._anonymiser.params(params)
+            body = self._anonymiser.body(body)
+        self._write({
+            'path': path,
+            'params': params,
+            'status': resp.status_code,
+            'elapsed': elapsed,
+            'body': body,
+        })
+        return resp
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+class ReplayResponse:
+
+    '''Minimal stand-in for requests.Response built from a cassette record'''
+
+    def __init__(self, status_code, text):
+        self.status_code = status_code
+        self.text = text
+
+    def json(self):
+        return json.loads(self.text)
+
+class ReplaySession:
+
+    '''
+    Serves responses from a cassette instead of bucketd.
+
+    Responses are matched by request path and params, falling back to the
+    request path alone in recorded order for anonymised params. All
+    requests for a given bucket are issued sequentially by one worker.
+    Each response is delayed by its recorded latency divided by `speed`.
+    '''
+
+    def __init__(self, path, speed=1.0):
+        self._speed = speed
+        self._lock = threading.Lock()
+        self._responses = defaultdict(deque)
+        self._exact = defaultdict(deque)
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            header = json.loads(next(f))
+            if header.get('version') != CASSETTE_VERSION:
+                raise ValueError('Unsupported cassette version %s'%header.get('version'))
+            self.anonymised = header.get('anonymised', False)
+            for line in f:
+                record = json.loads(line)
+                record['used'] = False
+                self._responses[record['path']].append(record)
+                self._exact[self._match_key(record['path'], record['params'])].append(record)
+
+    @staticmethod
+    def _match_key(path, params):
+        return path, json.dumps(params, sort_keys=True)
+
+    @staticmethod
+    def _pop_unused(records):
+        while records:
+            record = records.popleft()
+            if not record['used']:
+                record['used'] = True
+                return record
+        return None
+
+    def get(self, url, params=None, **kwargs):
+        path = urllib.parse.urlsplit(url).path
+        with self._lock:
+            record = self._pop_unused(self._exact[self._match_key(path, params)])
+            if record is None:
+                record = self._pop_unused(self._responses[path])
+            if record is None:
+                raise CassetteMiss(path)
+        if self._speed > 0:
+            time.sleep(record['elapsed'] / self._speed)
+        return ReplayResponse(record['status'], record['body'])
+
+    def close(self):
+        pass
+
+class BucketDEndpoints:
+
+    '''
+    Tracks the load and health of a set of bucketd endpoints.
+
+    Requests go to the endpoint with the lowest expected wait, its outstanding
+    requests times its average latency. Endpoints without a successful request
+    yet are assumed to have the average latency of the others. Endpoints
+    failing repeatedly are evicted for a while, unless no other endpoint is left.
+    '''
+
+    def __init__(self, addrs, eviction_failures=ENDPOINT_EVICTION_FAILURES,
+                 eviction_seconds=ENDPOINT_EVICTION_SECONDS):
+        self._addrs = list(addrs)
+        self._eviction_failures = eviction_failures
+        self._eviction_seconds = eviction_seconds
+        self._lock = threading.Lock()
+        self._outstanding = {addr: 0 for addr in self._addrs}
+        self._latency = {addr: None for addr in self._addrs}
+        self._failures = {addr: 0 for addr in self._addrs}
+        self._evicted_until = {addr: 0.0 for addr in self._addrs}
+
+    def _healthy(self, now):
+        return [addr for addr in self._addrs if self._evicted_until[addr] <= now]
+
+    def _expected_wait(self, addr, default_latency):
+        latency = self._latency[addr]
+        if latency is None:
+            latency = default_latency
+        return (self._outstanding[addr] + 1) * latency, self._outstanding[addr]
+
+    def acquire(self, preferred=None, exclude=()):
+        '''
+        Returns the endpoint to use for the next request and counts it as outstanding.
+        `preferred` is kept as long as it is healthy. Endpoints in `exclude`
+        are only used when no other endpoint is healthy.
+        '''
+        with self._lock:
+            healthy = self._healthy(time.monotonic())
+            healthy = [a for a in healthy if a not in exclude] or healthy
+            if preferred in healthy:
+                addr = preferred
+            elif healthy:
+                known = [l for l in self._latency.values() if l is not None]
+                default_latency = sum(known) / len(known) if known else 1.0
+                addr = min(healthy, key=lambda a: self._expected_wait(a, default_latency))
+            else:
+                addr = min(self._addrs, key=lambda a: self._evicted_until[a])
+            self._outstanding[addr] += 1
+            return addr
+
+    def release(self, addr, elapsed=None):
+        '''Marks a request as done, `elapsed` is None if it failed'''
+        with self._lock:
+            self._outstanding[addr] -= 1
+            if elapsed is not None:
+                self._failures[addr] = 0
+                if self._latency[addr] is None:
+                    self._latency[addr] = elapsed
+                else:
+                    self._latency[addr] += ENDPOINT_LATENCY_SMOOTHING * (elapsed - self._latency[addr])
+                return
+            self._failures[addr] += 1
+            if self._failures[addr] >= self._eviction_failures and len(self._addrs) > 1:
+                _log.warning('Evicting bucketd endpoint %s for %s secs'%(addr, self._eviction_seconds))
+                self._evicted_until[addr] = time.monotonic() + self._eviction_seconds
+                self._failures[addr] = 0
+
+    def has_alternative(self, exclude):
+        '''Returns whether a healthy endpoint outside of `exclude` is left'''
+        with self._lock:
+            return any(a not in exclude for a in self._healthy(time.monotonic()))
 
 class BucketDClient:
 
     '''Performs Listing calls against bucketd'''
-    __url_attribute_format = '{addr}/default/attributes/{bucket}'
-    __url_bucket_format = '{addr}/default/bucket/{bucket}'
+    __path_attribute_format = '/default/attributes/{bucket}'
+    __path_bucket_format = '/default/bucket/{bucket}'
     __headers = {"x-scal-request-uids": "utapi-reindex-list-buckets"}
 
-    def __init__(self, bucketd_addr=None, max_retries=2, only_latest_when_locked=False):
-        self._bucketd_addr = bucketd_addr
+    def __init__(self, bucketd_addr=None, max_retries=2, only_latest_when_locked=False, session=None):
+        if isinstance(bucketd_addr, str):
+            bucketd_addr = [bucketd_addr]
+        self._endpoints = BucketDEndpoints(bucketd_addr)
         self._max_retries = max_retries
         self._only_latest_when_locked = only_latest_when_locked
-        self._session = requests.Session()
+        # session can be a RecordingSession or ReplaySession to capture or replay traffic
+        self._session = session if session is not None else requests.Session()
 
-    def _do_req(self, url, check_500=True, **kwargs):
-        # Add 1 for the initial request
+    def _do_req(self, path, check_500=True, endpoint=None, **kwargs):
+        '''
+        Sends a GET request to the least loaded bucketd endpoint, or to
+        `endpoint` while it is healthy. Returns the endpoint used and the response.
+        Each round tries every healthy endpoint once before sleeping, and up to
+        `max_retries` more rounds are made before giving up.
+        '''
+        # Add 1 for the initial round
         for x in range(self._max_retries + 1):
-            try:
-                resp = self._session.get(url, timeout=30, verify=False, headers=self.__headers, **kwargs)
-                if check_500 and resp.status_code == 500:
-                    _log.warning('500 from bucketd, sleeping 15 secs')
-                    time.sleep(15)
-                    continue
-                return resp
-            except (Timeout, ConnectionError) as e:
-                _log.exception(e)
-                _log.error('Error during listing, sleeping 5 secs %s'%url)
-                time.sleep(5)
-
-        raise MaxRetriesReached(url)
+            failed = set()
+            got_500 = False
+            while True:
+                endpoint = self._endpoints.acquire(endpoint, exclude=failed)
+                url = endpoint + path
+                start = time.monotonic()
+                try:
+                    with _profiler.phase('http'):
+                        resp = self._session.get(url, timeout=30, verify=False, headers=self.__headers, **kwargs)
+                except (Timeout, ConnectionError) as e:
+                    self._endpoints.release(endpoint)
+                    _log.exception(e)
+                    _log.error('Error during listing %s'%url)
+                else:
+                    if not check_500 or resp.status_code != 500:
+                        self._endpoints.release(endpoint, time.monotonic() - start)
+                        return endpoint, resp
+                    self._endpoints.release(endpoint)
+                    _log.warning('500 from bucketd %s'%endpoint)
+                    got_500 = True
+                failed.add(endpoint)
+                endpoint = None
+                if not self._endpoints.has_alternative(failed):
+                    break
+                _log.warning('Retrying on another endpoint %s'%path)
+            if x < self._max_retries:
+                delay = 15 if got_500 else 5
+                _log.warning('All bucketd endpoints failed, sleeping %s secs'%delay)
+                time.sleep(delay)
+
+        raise MaxRetriesReached(path)
 
     def _list_bucket(self, bucket, **kwargs):
         '''
@@ -141,24 +632,27 @@ class BucketDClient:
         parameters value. On the first request the function will be called with
         `None` and should return its initial value. Return `None` for the param to be excluded.
         '''
-        url = self.__url_bucket_format.format(addr=self._bucketd_addr, bucket=bucket)
+        path = self.__path_bucket_format.format(bucket=bucket)
         static_params = {k: v for k, v in kwargs.items() if not callable(v)}
         dynamic_params = {k: v for k, v in kwargs.items() if callable(v)}
         is_truncated = True # Set to True for first loop
         payload = None
+        endpoint = None # Pages of a listing stick to one endpoint while it is healthy
         while is_truncated:
             params = static_params.copy() # Use a copy of the static params for a base
             for key, func in dynamic_params.items():
                 params[key] = func(payload) # Call each of our dynamic params with the previous payload
             try:
-                _log.debug('listing bucket bucket: %s params: %s'%(
-                    bucket, ', '.join('%s=%s'%p for p in params.items())))
-                resp = self._do_req(url, params=params)
+                if _log.isEnabledFor(logging.DEBUG):
+                    _log.debug('listing bucket bucket: %s params: %s'%(
+                        bucket, ', '.join('%s=%s'%p for p in params.items())))
+                endpoint, resp = self._do_req(path, endpoint=endpoint, params=params)
                 if resp.status_code == 404:
-                    _log.debug('Bucket not found bucket: %s'%bucket)
+                    _log.debug('Bucket not found bucket: %s', bucket)
                     return
                 if resp.status_code == 200:
-                    payload = resp.json()
+                    with _profiler.phase('decode'):
+                        payload = resp.json()
             except ValueError as e:
                 _log.exception(e)
                 _log.error('Invalid listing response body! bucket:%s params:%s'%(
@@ -180,14 +674,14 @@ class BucketDClient:
 
     @functools.lru_cache(maxsize=16)
     def _get_bucket_attributes(self, name):
-        url = self.__url_attribute_format.format(addr=self._bucketd_addr, bucket=name)
+        path = self.__path_attribute_format.format(bucket=name)
         try:
-            resp = self._do_req(url)
+            _, resp = self._do_req(path)
             if resp.status_code == 200:
                 return resp.json()
             else:
                 _log.error('Error getting bucket attributes bucket:%s status_code:%s'%(name, resp.status_code))
-                raise BucketNotFound(name)
+                raise BucketNotFound(name, resp.status_code)
         except ValueError as e:
             _log.exception(e)
             _log.error('Invalid attributes response body! bucket:%s'%name)
@@ -208,11 +702,15 @@ class BucketDClient:
             raise InvalidListing(name)
         return Bucket(canonId, name, md.get('objectLockEnabled', False))
 
-    def list_buckets(self, account=None):
+    def list_buckets(self, account=None, marker='', end=None):
+        '''
+        Lists buckets in batches, from all accounts or from `account`.
+        `marker` and `end` restrict the listing to the key range (marker, end].
+        '''
 
         def get_next_marker(p):
             if p is None:
-                return ''
+                return marker
             return p.get('Contents', [{}])[-1].get('key', '')
 
         params = {
@@ -226,7 +724,11 @@ class BucketDClient:
 
         for _, payload in self._list_bucket(USERS_BUCKET, **params):
             buckets = []
+            reached_end = False
             for result in payload.get('Contents', []):
+                if end is not None and result['key'] > end:
+                    reached_end = True
+                    break
                 match = re.match("(\w+)..\|..(\w+.*)", result['key'])
                 bucket = Bucket(*match.groups(), False)
                 # We need to get the attributes for each bucket to determine if it is locked
@@ -238,6 +740,8 @@ class BucketDClient:
 
             if buckets:
                 yield buckets
+            if reached_end:
+                return
 
     def list_mpus(self, bucket):
         _bucket = MPU_SHADOW_BUCKET_PREFIX + bucket.name
@@ -279,25 +783,26 @@ class BucketDClient:
         total_size = 0
         last_key = None
         try:
-            for obj in listing:
-                if isinstance(obj['value'], dict):
-                    # bucketd v6 returns a dict:
-                    data = obj.get('value', {})
-                    size = data["Size"]
-                else:
-                    # bucketd v7 returns an encoded string
-                    data = json.loads(obj['value'])
-                    size = data.get('content-length', 0)
-
-                is_latest = obj['key'] != last_key
-                last_key = obj['key']
-
-                if only_latest_when_locked and bucket.object_lock_enabled and not is_latest:
-                    _log.debug('Skipping versioned key: %s'%obj['key'])
-                    continue
-
-                count += 1
-                total_size += size
+            with _profiler.phase('sum'):
+                for obj in listing:
+                    if isinstance(obj['value'], dict):
+                        # bucketd v6 returns a dict:
+                        data = obj.get('value', {})
+                        size = data["Size"]
+                    else:
+                        # bucketd v7 returns an encoded string
+                        data = json.loads(obj['value'])
+                        size = data.get('content-length', 0)
+
+                    is_latest = obj['key'] != last_key
+                    last_key = obj['key']
+
+                    if only_latest_when_locked and bucket.object_lock_enabled and not is_latest:
+                        _log.debug('Skipping versioned key: %s', obj['key'])
+                        continue
+
+                    count += 1
+                    total_size += size
 
         except InvalidListing:
             _log.error('Invalid contents in listing. bucket:%s'%bucket.name)
@@ -312,11 +817,11 @@ class BucketDClient:
             for obj in contents:
                 yield obj
 
-    def count_bucket_contents(self, bucket):
+    def _list_versions(self, name, key_marker=''):
 
         def get_key_marker(p):
             if p is None:
-                return ''
+                return key_marker
             return p.get('NextKeyMarker', '')
 
         def get_vid_marker(p):
@@ -331,14 +836,155 @@ class BucketDClient:
             'versionIdMarker': get_vid_marker,
         }
 
-        listing = self._list_bucket(bucket.name, **params)
-        count, total_size = self._sum_objects(bucket, self._extract_listing('Versions', listing), self._only_latest_when_locked)
+        listing = self._list_bucket(name, **params)
+        return self._extract_listing('Versions', listing)
+
+    def count_bucket_contents(self, bucket):
+        listing = self._list_versions(bucket.name)
+        count, total_size = self._sum_objects(bucket, listing, self._only_latest_when_locked)
         return BucketContents(
             bucket=bucket,
             obj_count=count,
             total_size=total_size
         )
 
+    def _list_key_range(self, bucket, lower, upper):
+        '''
+        Lists the versions whose key is in the range (lower, upper].
+        An upper bound of `None` lists until the end of the bucket.
+        '''
+        listing = self._list_versions(bucket.name, key_marker=lower)
+        if upper is not None:
+            listing = itertools.takewhile(lambda obj: obj['key'] <= upper, listing)
+        return listing
+
+    def _count_key_range(self, bucket, lower, upper):
+        listing = self._list_key_range(bucket, lower, upper)
+        return self._sum_objects(bucket, listing, self._only_latest_when_locked)
+
+    def _probe_key_range(self, bucket, lower, upper, limit):
+        '''
+        Counts at most `limit` versions of the range (lower, upper].
+        Returns the count, the size, whether the whole range was counted and
+        the first key listed after the range, `None` at the end of the bucket.
+        '''
+        listing = self._list_versions(bucket.name, key_marker=lower)
+        after = []
+
+        def in_range():
+            for obj in listing:
+                if upper is not None and obj['key'] > upper:
+                    after.append(obj['key'])
+                    return
+                yield obj
+
+        versions = in_range()
+        count, total_size = self._sum_objects(bucket, itertools.islice(versions, limit), self._only_latest_when_locked)
+        complete = next(versions, None) is None
+        return count, total_size, complete, after[0] if after else None
+
+    @staticmethod
+    def _sub_key_range(lower, upper, index):
+        '''
+        Returns the sub range `index` of (lower, upper] split on the character
+        following `lower`: (lower + chr(index - 1), lower + chr(index)], with
+        `lower` as the first lower bound and `upper` as the last upper bound.
+        '''
+        sub_lower = lower if index == 0 else lower + chr(index - 1)
+        if index >= ESTIMATE_SPLIT_CHARACTERS:
+            return sub_lower, upper
+        sub_upper = lower + chr(index)
+        if upper is not None and sub_upper >= upper:
+            return sub_lower, upper
+        return sub_lower, sub_upper
+
+    @staticmethod
+    def _sub_key_range_index(lower, key):
+        '''Returns the index of the sub range of `lower` holding `key`'''
+        if not key.startswith(lower) or len(key) == len(lower):
+            return ESTIMATE_SPLIT_CHARACTERS
+        index = ord(key[len(lower)])
+        # lower + chr(index) itself is the upper bound of sub range `index`
+        return index if len(key) == len(lower) + 1 else index + 1
+
+    def _split_key_range(self, bucket, lower, upper):
+        '''
+        Splits (lower, upper] on the character following `lower` and probes
+        the sub ranges. Empty sub ranges are skipped using the first key found
+        after each probe. Returns the count and size of the sub ranges counted
+        exactly, and the sub ranges too large to be probed.
+        '''
+        exact_count, exact_size, large = 0, 0, []
+        index = 0
+        while True:
+            sub_lower, sub_upper = self._sub_key_range(lower, upper, index)
+            count, total_size, complete, next_key = self._probe_key_range(bucket, sub_lower, sub_upper, ESTIMATE_PROBE_SIZE)
+            if complete:
+                exact_count += count
+                exact_size += total_size
+            else:
+                large.append((sub_lower, sub_upper))
+            if sub_upper == upper or (complete and next_key is None):
+                break
+            if not complete:
+                index += 1
+                continue
+            if upper is not None and next_key > upper:
+                break
+            # Jump to the sub range holding the next key
+            index = max(index + 1, self._sub_key_range_index(lower, next_key))
+        return exact_count, exact_size, large
+
+    def estimate_bucket_contents(self, bucket, samples=ESTIMATE_DEFAULT_SAMPLES,
+                                 threshold=ESTIMATE_DEFAULT_THRESHOLD, rng=random):
+        '''
+        Estimates the object count and size of a bucket.
+
+        Buckets with no more than `threshold` versions are counted exactly.
+        Larger buckets have their key space split on the next key character,
+        starting from the whole bucket. Non empty sub ranges holding at most
+        ESTIMATE_PROBE_SIZE versions are counted exactly, larger ones are split
+        level by level until there are ESTIMATE_RANGES_PER_SAMPLE of them per
+        sample, so boundaries follow the bucket's key distribution. `samples` of the large
+        ranges are then counted and extrapolated with a simple random sampling
+        estimator. Margins are half-widths of the 95% confidence interval, or
+        `None` when they can not be computed.
+        '''
+        count, total_size, complete, _ = self._probe_key_range(bucket, '', None, threshold)
+        if complete:
+            return BucketEstimate(bucket, count, total_size, 0, 0, True)
+
+        exact_count, exact_size = 0, 0
+        # Whole levels are split so sampled ranges come from the same prefix depth
+        level = [('', None)]
+        ranges = [] # Large ranges that can not be split further
+        while level and len(level) + len(ranges) < samples * ESTIMATE_RANGES_PER_SAMPLE:
+            next_level = []
+            for lower, upper in level:
+                if len(lower) >= ESTIMATE_MAX_PREFIX_LENGTH:
+                    ranges.append((lower, upper))
+                    continue
+                count, total_size, sub_ranges = self._split_key_range(bucket, lower, upper)
+                exact_count += count
+                exact_size += total_size
+                if sub_ranges == [(lower, upper)]:
+                    # Nothing left to split on, e.g. many versions of a single key
+                    ranges.append((lower, upper))
+                    continue
+                next_level.extend(sub_ranges)
+            level = next_level
+        ranges.extend(level)
+        if not ranges:
+            return BucketEstimate(bucket, exact_count, exact_size, 0, 0, True)
+
+        sampled = rng.sample(ranges, min(samples, len(ranges)))
+        _log.debug('estimating bucket: %s from %s of %s key ranges', bucket.name, len(sampled), len(ranges))
+        counts, sizes = zip(*(self._count_key_range(bucket, lower, upper) for lower, upper in sampled))
+        obj_count, obj_count_margin = _extrapolate(counts, len(ranges))
+        total_size, total_size_margin = _extrapolate(sizes, len(ranges))
+        return BucketEstimate(bucket, exact_count + obj_count, exact_size + total_size,
+                              obj_count_margin, total_size_margin, len(sampled) == len(ranges))
+
     def count_mpu_parts(self, mpu):
         shadow_bucket_name = MPU_SHADOW_BUCKET_PREFIX + mpu.bucket.name
         shadow_bucket = mpu.bucket._replace(name=shadow_bucket_name)
@@ -369,12 +1015,81 @@ class BucketDClient:
             total_size=total_size
         )
 
-def list_all_buckets(bucket_client):
-    return bucket_client.list_buckets()
+def _extrapolate(values, population):
+    '''
+    Returns the estimated total of `population` units from a random sample of
+    their `values`, and the margin of error of that total. The margin is
+    `None` when the sample is too small or empty to tell the variance.
+    '''
+    n = len(values)
+    total = population * sum(values) / n
+    if n >= population:
+        return round(total), 0
+    if n < 2 or not any(values):
+        return round(total), None
+    # Variance of the total with finite population correction
+    variance = population ** 2 * (1 - n / population) * statistics.variance(values) / n
+    return round(total), round(ESTIMATE_Z_SCORE * math.sqrt(variance))
+
+def merge_listings(listings, workers):
+    '''
+        Iterates over the `listings` callables from `workers` threads and
+        yields their batches as they arrive. Any listing error is raised
+        once the other listings are done.
+    '''
+    listings = iter(listings)
+    lock = threading.Lock()
+    # Bounded so discovery does not run too far ahead of the counting stage
+    results = queue.Queue(maxsize=workers * 2)
+    done = object()
 
-def list_specific_accounts(bucket_client, accounts):
-    for account in accounts:
-        yield from bucket_client.list_buckets(account=account)
+    def run():
+        try:
+            while True:
+                with lock:
+                    listing = next(listings, None)
+                if listing is None:
+                    return
+                for batch in listing():
+                    results.put(batch)
+        except Exception as e:
+            _log.exception(e)
+            results.put(e)
+        finally:
+            results.put(done)
+
+    for _ in range(workers):
+        threading.Thread(target=run, daemon=True).start()
+
+    error = None
+    running = workers
+    while running:
+        result = results.get()
+        if result is done:
+            running -= 1
+        elif isinstance(result, Exception):
+            error = result
+        else:
+            yield result
+    if error is not None:
+        raise error
+
+def list_all_buckets(bucket_client, workers=1):
+    if workers <= 1:
+        return bucket_client.list_buckets()
+    ranges = zip(DISCOVERY_RANGE_BOUNDARIES, DISCOVERY_RANGE_BOUNDARIES[1:] + [None])
+    return merge_listings(
+        (functools.partial(bucket_client.list_buckets, marker=marker, end=end) for marker, end in ranges),
+        workers)
+
+def list_specific_accounts(bucket_client, accounts, workers=1):
+    if workers <= 1:
+        for account in accounts:
+            yield from bucket_client.list_buckets(account=account)
+        return
+    yield from merge_listings(
+        (functools.partial(bucket_client.list_buckets, account=account) for account in accounts),
+        workers)
 
 def list_specific_buckets(bucket_client, buckets):
     batch = []
@@ -393,13 +1108,15 @@ def index_bucket(client, bucket):
         tuple of BucketContents for the passed bucket and its mpu shadow bucket.
     '''
     try:
-        bucket_total = client.count_bucket_contents(bucket)
-        mpus = client.list_mpus(bucket)
+        with _profiler.bucket(bucket.name):
+            bucket_total = client.count_bucket_contents(bucket)
+            with _profiler.phase('mpu'):
+                mpus = client.list_mpus(bucket)
+                mpu_totals = [client.count_mpu_parts(m) for m in mpus]
         if not mpus:
             return bucket_total
 
         total_size = bucket_total.total_size
-        mpu_totals = [client.count_mpu_parts(m) for m in mpus]
         for mpu in mpu_totals:
             total_size += mpu.total_size
 
@@ -409,6 +1126,26 @@ def index_bucket(client, bucket):
         _log.error('Error during listing. Removing from results bucket:%s'%bucket.name)
         raise InvalidListing(bucket.name)
 
+def estimate_bucket(client, bucket, samples, threshold, seed=None):
+    '''
+        Takes an instance of BucketDClient and a bucket, and returns a
+        BucketEstimate for the passed bucket including its mpu shadow bucket.
+        MPU parts are always counted exactly.
+    '''
+    # Seed per bucket so sampling does not depend on thread scheduling
+    rng = random.Random(None if seed is None else '%s:%s' % (seed, bucket.name))
+    try:
+        with _profiler.bucket(bucket.name):
+            estimate = client.estimate_bucket_contents(bucket, samples, threshold, rng)
+            with _profiler.phase('mpu'):
+                mpus = client.list_mpus(bucket)
+                mpu_size = sum(client.count_mpu_parts(m).total_size for m in mpus)
+        return estimate._replace(total_size=estimate.total_size + mpu_size)
+    except Exception as e:
+        _log.exception(e)
+        _log.error('Error during estimation. Removing from results bucket:%s'%bucket.name)
+        raise InvalidListing(bucket.name)
+
 def update_report(report, key, obj_count, total_size):
     '''Convenience function to update the report dicts'''
     if key in report:
@@ -442,6 +1179,32 @@ def get_redis_client(options):
         password=options.redis_password
     )
 
+def _combine_margins(a, b):
+    '''Combines margins as independent errors, an unknown margin stays unknown'''
+    if a is None or b is None:
+        return None
+    return math.hypot(a, b)
+
+def update_estimate_report(report, key, estimate):
+    '''Convenience function to update the estimate report dicts'''
+    if key in report:
+        current = report[key]
+        report[key] = {
+            'obj_count': current['obj_count'] + estimate.obj_count,
+            'total_size': current['total_size'] + estimate.total_size,
+            'obj_count_margin': _combine_margins(current['obj_count_margin'], estimate.obj_count_margin),
+            'total_size_margin': _combine_margins(current['total_size_margin'], estimate.total_size_margin),
+            'exact': current['exact'] and estimate.exact,
+        }
+    else:
+        report[key] = {
+            'obj_count': estimate.obj_count,
+            'total_size': estimate.total_size,
+            'obj_count_margin': estimate.obj_count_margin,
+            'total_size_margin': estimate.total_size_margin,
+            'exact': estimate.exact,
+        }
+
 def update_redis(client, resource, name, obj_count, total_size):
     now = datetime.utcnow()
     # Round down to the nearest 15 minute interval
@@ -460,9 +1223,63 @@ def update_redis(client, resource, name, obj_count, total_size):
     client.zadd(total_size_key, {total_size_serialized: timestamp})
     client.set(obj_count_key + ':counter', obj_count)
     client.set(total_size_key + ':counter', total_size)
+    # Sorted set scores are doubles, values above 2^53 lose precision in the rankings
+    client.zadd(RANKING_KEY_FORMAT % (resource, 'numberOfObjects'), {name: obj_count})
+    client.zadd(RANKING_KEY_FORMAT % (resource, 'storageUtilized'), {name: total_size})
+
+def prune_rankings(client, resource, name):
+    client.zrem(RANKING_KEY_FORMAT % (resource, 'numberOfObjects'), name)
+    client.zrem(RANKING_KEY_FORMAT % (resource, 'storageUtilized'), name)
+
+def check_account_buckets(bucket_client, account, candidates):
+    '''
+        Takes an instance of BucketDClient and the recorded buckets of an
+        account missing from its listing. Returns the ones that no longer
+        exist, and the ones to keep in the account index. Bucket names can be
+        reused by another account, whose metrics must not be cleared.
+    '''
+    stale, kept = set(), set()
+    for name in candidates:
+        try:
+            bucket = bucket_client.get_bucket_md(name)
+        except BucketNotFound as e:
+            if e.status_code == 404:
+                stale.add(name)
+            else:
+                kept.add(name)
+            continue
+        except Exception as e:
+            _log.exception(e)
+            _log.error('Failed to check the owner of bucket %s, not clearing it'%name)
+            kept.add(name)
+            continue
+        if bucket.userid == account:
+            kept.add(name)
+        else:
+            _log.info('Bucket %s is now owned by %s, removing it from the index of account %s'%(name, bucket.userid, account))
+    return stale, kept
+
+def get_account_buckets(client, accounts):
+    '''Returns a dict of account to the bucket names last reported for it'''
+    account_buckets = {}
+    for chunk in chunks(accounts, ACCOUNT_UPDATE_CHUNKSIZE):
+        pipeline = client.pipeline(transaction=False) # No transaction to reduce redis load
+        for account in chunk:
+            pipeline.smembers(ACCOUNT_BUCKETS_KEY_FORMAT % account)
+        with _profiler.phase('redis'):
+            results = pipeline.execute()
+        for account, members in zip(chunk, results):
+            account_buckets[account] = {m.decode('utf-8') for m in members}
+    return account_buckets
+
+def set_account_buckets(client, account, buckets):
+    key = ACCOUNT_BUCKETS_KEY_FORMAT % account
+    client.delete(key)
+    if buckets:
+        client.sadd(key, *buckets)
 
 def get_resources_from_redis(client, resource):
-    for key in redis_client.scan_iter('s3:%s:*:storageUtilized' % resource):
+    for key in client.scan_iter('s3:%s:*:storageUtilized' % resource):
         yield key.decode('utf-8').split(':')[2]
 
 def log_report(resource, name, obj_count, total_size):
@@ -473,23 +1290,111 @@ def log_report(resource, name, obj_count, total_size):
         total_size
     ))
 
+def _format_margin(margin):
+    return 'unknown' if margin is None else round(margin)
+
+def log_estimate(resource, name, report):
+    print('%s:%s:%s:%s:%s:%s:%s'%(
+        resource,
+        name,
+        report['obj_count'],
+        _format_margin(report['obj_count_margin']),
+        report['total_size'],
+        _format_margin(report['total_size_margin']),
+        'exact' if report['exact'] else 'estimated'
+    ))
+
+def run_estimate(options, bucket_client, batch_generator):
+    '''
+        Estimates bucket and account utilization and prints the reports.
+        Redis is only updated when --estimate-write is passed.
+    '''
+    write = options.estimate_write and not options.dry_run
+    redis_client = get_redis_client(options) if write else None
+    account_reports = {}
+    failed_accounts = set()
+
+    with ThreadPoolExecutor(max_workers=options.worker) as executor:
+        for batch in batch_generator:
+            bucket_reports = {}
+            jobs = { executor.submit(estimate_bucket, bucket_client, b, options.estimate_samples, options.estimate_threshold, options.estimate_seed): b for b in batch }
+            for job in futures.as_completed(jobs.keys()):
+                try:
+                    estimate = job.result()
+                except InvalidListing:
+                    _bucket = jobs[job]
+                    _log.error('Failed to estimate bucket %s. Removing from results.'%_bucket.name)
+                    failed_accounts.add(_bucket.userid)
+                    continue
+                update_estimate_report(bucket_reports, estimate.bucket.name, estimate)
+                update_estimate_report(account_reports, estimate.bucket.userid, estimate)
+
+            pipeline = redis_client.pipeline(transaction=False) if write else None
+            for bucket, report in bucket_reports.items():
+                log_estimate('buckets', bucket, report)
+                if write:
+                    update_redis(pipeline, 'buckets', bucket, report['obj_count'], report['total_size'])
+            if write:
+                with _profiler.phase('redis'):
+                    pipeline.execute()
+
+    if options.bucket:
+        return
+
+    without_failed = filter(lambda x: x[0] not in failed_accounts, account_reports.items())
+    for chunk in chunks(without_failed, ACCOUNT_UPDATE_CHUNKSIZE):
+        pipeline = redis_client.pipeline(transaction=False) if write else None
+        for userid, report in chunk:
+            log_estimate('accounts', userid, report)
+            if write:
+                update_redis(pipeline, 'accounts', userid, report['obj_count'], report['total_size'])
+        if write:
+            with _profiler.phase('redis'):
+                pipeline.execute()
+
+    for account in failed_accounts:
+        _log.error("No estimate reported for account %s, one or more buckets failed" % account)
+
 if __name__ == '__main__':
     options = get_options()
     if options.debug:
         _log.setLevel(logging.DEBUG)
 
-    bucket_client = BucketDClient(options.bucketd_addr, options.max_retries, options.only_latest_when_locked)
-    redis_client = get_redis_client(options)
-    account_reports = {}
-    observed_buckets = set()
-    failed_accounts = set()
+    if options.profile:
+        _profiler = PhaseProfiler(options.profile, options.profile_bucket)
+        atexit.register(_profiler.write)
+
+    session = None
+    if options.record:
+        session = RecordingSession(options.record, anonymiser=KeyAnonymiser() if options.record_anonymise else None)
+    elif options.replay:
+        session = ReplaySession(options.replay, options.replay_speed)
+        if options.estimate and session.anonymised:
+            _log.error('Anonymised cassettes do not keep key ordering and can not be replayed with --estimate')
+            sys.exit(1)
+    if session is not None:
+        atexit.register(session.close)
+
+    bucket_client = BucketDClient(options.bucketd_addr, options.max_retries, options.only_latest_when_locked, session)
 
     if options.account:
-        batch_generator = list_specific_accounts(bucket_client, options.account)
+        batch_generator = list_specific_accounts(bucket_client, options.account, options.discovery_workers)
     elif options.bucket:
         batch_generator = list_specific_buckets(bucket_client, options.bucket)
     else:
-        batch_generator = list_all_buckets(bucket_client)
+        batch_generator = list_all_buckets(bucket_client, options.discovery_workers)
+
+    if options.estimate:
+        # Estimates never clear stale entries as buckets are not fully observed
+        run_estimate(options, bucket_client, batch_generator)
+        sys.exit(0)
+
+    redis_client = get_redis_client(options)
+    account_reports = {}
+    observed_buckets = set()
+    failed_accounts = set()
+    # Observed bucket names per account, including failed ones
+    observed_account_buckets = defaultdict(set)
 
     with ThreadPoolExecutor(max_workers=options.worker) as executor:
         for batch in batch_generator:
@@ -503,10 +1408,12 @@ if __name__ == '__main__':
                     _log.error('Failed to list bucket %s. Removing from results.'%_bucket.name)
                     # Add the bucket to observed_buckets anyway to avoid clearing existing metrics
                     observed_buckets.add(_bucket.name)
+                    observed_account_buckets[_bucket.userid].add(_bucket.name)
                     # If we can not list one of an account's buckets we can not update its total
                     failed_accounts.add(_bucket.userid)
                     continue
                 observed_buckets.add(total.bucket.name)
+                observed_account_buckets[total.bucket.userid].add(total.bucket.name)
                 update_report(bucket_reports, total.bucket.name, total.obj_count, total.total_size)
                 update_report(account_reports, total.bucket.userid, total.obj_count, total.total_size)
 
@@ -523,15 +1430,22 @@ if __name__ == '__main__':
                 for bucket, report in bucket_reports.items():
                     update_redis(pipeline, 'buckets', bucket, report['obj_count'], report['total_size'])
                     log_report('buckets', bucket, report['obj_count'], report['total_size'])
-                pipeline.execute()
+                with _profiler.phase('redis'):
+                    pipeline.execute()
 
     stale_buckets = set()
-    recorded_buckets = set(get_resources_from_redis(redis_client, 'buckets'))
     if options.bucket:
         stale_buckets = { b for b in options.bucket if b not in observed_buckets }
     elif options.account:
-        _log.warning('Stale buckets will not be cleared when using the --account or --account-file flags')
+        # Only buckets recorded in the account indexes are cleared, they are filled by previous runs
+        recorded_account_buckets = get_account_buckets(redis_client, options.account)
+        for account, recorded in recorded_account_buckets.items():
+            candidates = recorded.difference(observed_account_buckets[account])
+            stale, kept = check_account_buckets(bucket_client, account, candidates)
+            stale_buckets.update(stale)
+            observed_account_buckets[account].update(kept)
     else:
+        recorded_buckets = set(get_resources_from_redis(redis_client, 'buckets'))
         stale_buckets = recorded_buckets.difference(observed_buckets)
 
     _log.info('Found %s stale buckets' % len(stale_buckets))
@@ -542,8 +1456,27 @@ if __name__ == '__main__':
             pipeline = redis_client.pipeline(transaction=False) # No transaction to reduce redis load
             for bucket in chunk:
                 update_redis(pipeline, 'buckets', bucket, 0, 0)
+                prune_rankings(pipeline, 'buckets', bucket)
                 log_report('buckets', bucket, 0, 0)
-            pipeline.execute()
+            with _profiler.phase('redis'):
+                pipeline.execute()
+
+    if options.dry_run:
+        _log.info("DryRun: not updating account bucket indexes")
+    else:
+        # Buckets can only be added to the indexes when listed individually
+        indexed_accounts = list(observed_account_buckets.keys())
+        if options.account:
+            indexed_accounts = list(set(indexed_accounts).union(options.account))
+        for chunk in chunks(indexed_accounts, ACCOUNT_UPDATE_CHUNKSIZE):
+            pipeline = redis_client.pipeline(transaction=False) # No transaction to reduce redis load
+            for account in chunk:
+                if options.bucket:
+                    pipeline.sadd(ACCOUNT_BUCKETS_KEY_FORMAT % account, *observed_account_buckets[account])
+                else:
+                    set_account_buckets(pipeline, account, observed_account_buckets[account])
+            with _profiler.phase('redis'):
+                pipeline.execute()
 
     # Account metrics are not updated if a bucket is specified
     if options.bucket:
@@ -565,7 +1498,8 @@ if __name__ == '__main__':
                 for userid, report in chunk:
                     update_redis(pipeline, 'accounts', userid, report['obj_count'], report['total_size'])
                     log_report('accounts', userid, report['obj_count'], report['total_size'])
-                pipeline.execute()
+                with _profiler.phase('redis'):
+                    pipeline.execute()
 
         if options.account:
             for account in options.account:
@@ -574,12 +1508,12 @@ if __name__ == '__main__':
 
         # Include failed_accounts in observed_accounts to avoid clearing metrics
         observed_accounts = failed_accounts.union(set(account_reports.keys()))
-        recorded_accounts = set(get_resources_from_redis(redis_client, 'accounts'))
 
         if options.account:
             stale_accounts = { a for a in options.account if a not in observed_accounts }
         else:
             # Stale accounts and buckets are ones that do not appear in the listing, but have recorded values
+            recorded_accounts = set(get_resources_from_redis(redis_client, 'accounts'))
             stale_accounts = recorded_accounts.difference(observed_accounts)
 
         _log.info('Found %s stale accounts' % len(stale_accounts))
@@ -590,5 +1524,8 @@ if __name__ == '__main__':
                 pipeline = redis_client.pipeline(transaction=False) # No transaction to reduce redis load
                 for account in chunk:
                     update_redis(pipeline, 'accounts', account, 0, 0)
+                    prune_rankings(pipeline, 'accounts', account)
+                    pipeline.delete(ACCOUNT_BUCKETS_KEY_FORMAT % account)
                     log_report('accounts', account, 0, 0)
-                pipeline.execute()
+                with _profiler.phase('redis'):
+                    pipeline.execute()
@@ -0,0 +1,89 @@
+# Run with: python3 -m unittest discover -s tests/unit/reindex
+
+import bisect
+import json
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', '..', 'lib', 'reindex'))
+
+import s3_bucketd  # noqa: E402
+
+
+class FakeResponse:
+
+    def __init__(self, body):
+        self.status_code = 200
+        self.body = body
+        self.text = json.dumps(body)
+
+    def json(self):
+        return self.body
+
+
+class FakeBucketDSession:
+
+    '''Serves DelimiterVersions listings of a sorted list of (key, versionId)'''
+
+    # Splitting must terminate well before listing every key one page at a time
+    max_requests = 1000
+
+    def __init__(self, versions):
+        self.versions = versions
+        self.requests = 0
+
+    def get(self, url, params=None, **kwargs):
+        self.requests += 1
+        if self.requests > self.max_requests:
+            raise AssertionError('too many listing requests')
+        marker = (params['keyMarker'], params['versionIdMarker'] or chr(0x10ffff))
+        start = bisect.bisect_right(self.versions, marker)
+        page = self.versions[start:start + params['maxKeys']]
+        body = {
+            'Versions': [{'key': key, 'versionId': vid, 'value': json.dumps({'content-length': 10})}
+                         for key, vid in page],
+            'IsTruncated': start + len(page) < len(self.versions),
+        }
+        if page:
+            body['NextKeyMarker'], body['NextVersionIdMarker'] = page[-1]
+        return FakeResponse(body)
+
+
+class TestEstimateBucketContents(unittest.TestCase):
+
+    bucket = s3_bucketd.Bucket('userid', 'bucket', False)
+
+    def estimate(self, keys, samples=3):
+        session = FakeBucketDSession(sorted((key, 'v1') for key in keys))
+        client = s3_bucketd.BucketDClient('http://bucketd', session=session)
+        return client.estimate_bucket_contents(self.bucket, samples, 10000, random.Random(0))
+
+    def assertEstimates(self, estimate, count):
+        margin = estimate.obj_count_margin or 0
+        self.assertLessEqual(abs(estimate.obj_count - count), max(margin, count // 10))
+        self.assertEqual(estimate.total_size, estimate.obj_count * 10)
+
+    def test_small_bucket_is_exact(self):
+        estimate = self.estimate(['key%d' % i for i in range(100)])
+        self.assertEqual((estimate.obj_count, estimate.total_size, estimate.exact), (100, 1000, True))
+
+    def test_keys_with_spaces(self):
+        self.assertEstimates(self.estimate(['a b/%06d' % i for i in range(50000)]), 50000)
+
+    def test_keys_with_control_characters(self):
+        self.assertEstimates(self.estimate(['a\tb/%06d' % i for i in range(50000)]), 50000)
+
+    def test_non_ascii_keys(self):
+        self.assertEstimates(self.estimate(['データ/%06d' % i for i in range(50000)]), 50000)
+
+    def test_versions_of_a_single_key(self):
+        session = FakeBucketDSession([('key', '%08d' % i) for i in range(30000)])
+        client = s3_bucketd.BucketDClient('http://bucketd', session=session)
+        estimate = client.estimate_bucket_contents(self.bucket, 3, 10000, random.Random(0))
+        self.assertEqual((estimate.obj_count, estimate.exact), (30000, True))
+
+
+if __name__ == '__main__':
+    unittest.main()